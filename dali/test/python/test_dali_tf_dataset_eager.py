@@ -109,6 +109,14 @@ start_values = [[np.full((2, 4), 42, dtype=np.int64),
                     np.full((2, 4), 42, dtype=np.int64),
                     np.full((3, 5), 666.0, dtype=np.float32),
                     np.full((1, 7), -5, dtype=np.int8)
+                ],
+                [
+                    np.full((3, 5), 1.5, dtype=np.float32),
+                    np.full((3, 5), 2.5, dtype=np.float32)
+                ],
+                [
+                    np.array(7, dtype=np.int32),
+                    np.array(8, dtype=np.int32)
                 ]]
 
 input_names = [["input_{}".format(i) for i, _ in enumerate(vals)] for vals in start_values]
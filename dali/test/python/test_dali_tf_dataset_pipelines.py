@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import sys
+
 import nvidia.dali as dali
 import nvidia.dali.fn as fn
 import nvidia.dali.plugin.tf as dali_tf
@@ -23,9 +26,24 @@ from test_utils import  RandomlyShapedDataIterator
 
 import numpy as np
 
-
 from nose.tools import nottest
 
+
+# Types that DALI promotes to INT32 when combined with a Python int (INT32) constant
+_PROMOTED_TO_INT32 = {np.dtype(t) for t in (np.bool_, np.int8, np.int16, np.int32,
+                                            np.uint8, np.uint16)}
+
+
+def _add_ten_as_int32(input, dtype):
+    """Compute `input + 10` as INT32. When the arithmetic expression already produces INT32,
+    the separate cast kernel (and the additional pass over the batch) is skipped. The cast is
+    always used when the `dtype` is not known (None).
+    """
+    if dtype is not None and np.dtype(dtype) in _PROMOTED_TO_INT32:
+        return input + 10
+    return fn.cast(input + 10, dtype=dali.types.INT32)
+
+
 class RandomSampleIterator:
     def __init__(self,
                  max_shape=(10, 600, 800, 3),
@@ -33,7 +51,8 @@ class RandomSampleIterator:
                  start=0,
                  stop=1e100,
                  min_shape=None,
-                 seed=42):
+                 seed=42,
+                 prefetch_samples=8):
         self.start = start
         self.stop = stop
         self.min_shape = min_shape
@@ -41,21 +60,36 @@ class RandomSampleIterator:
         # As tf passes only tensors to the iterator, we pass a dummy value of which we take the type
         self.dtype = dtype_sample.dtype
         self.seed = seed
+        self.prefetch_samples = prefetch_samples
+        self.random_iter = None
 
     def __iter__(self):
-        self.n = self.start
-        self.random_iter = iter(RandomlyShapedDataIterator(batch_size=1, min_shape=self.min_shape,
-                max_shape=self.max_shape, seed=self.seed, dtype=self.dtype))
+        # `stop` is inclusive, the default value of 1e100 means there is no limit
+        if self.stop >= sys.maxsize:
+            num_samples = None
+        else:
+            num_samples = max(0, int(self.stop) - int(self.start) + 1)
+        if self.random_iter is None:
+            # The samples are drawn `prefetch_samples` at a time (but not more than needed) and
+            # served one by one, it yields the same sequence as drawing them separately
+            batch_size = self.prefetch_samples
+            if num_samples is not None:
+                batch_size = max(1, min(batch_size, num_samples))
+            self.random_iter = iter(RandomlyShapedDataIterator(batch_size=batch_size,
+                    min_shape=self.min_shape, max_shape=self.max_shape, seed=self.seed,
+                    dtype=self.dtype))
+        else:
+            # Restart the sequence instead of constructing and seeding a new iterator
+            self.random_iter.reset()
+        self.samples = itertools.islice(self._generate_samples(), num_samples)
         return self
 
     def __next__(self):
-        if self.n <= self.stop:
-            result = self.n
-            self.n += 1
-            ret = self.random_iter.next()[0]
-            return ret
-        else:
-            raise StopIteration
+        return next(self.samples)
+
+    def _generate_samples(self):
+        while True:
+            yield from self.random_iter.next()
 
 
 class FixedSampleIterator:
@@ -63,25 +97,46 @@ class FixedSampleIterator:
         self.value = value
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        return self.value
+        # `itertools.repeat` is implemented in C, so there is no Python `__next__` call per sample
+        return itertools.repeat(self.value)
 
 class InfiniteSampleIterator:
-    def __init__(self, start_value):
-        self.value = start_value
+    """Yields `start_value`, `start_value + 1`, `start_value + 2`, ...
+
+    Consecutive samples are generated in blocks of `block_size` with a single NumPy operation,
+    so `__next__` only returns a view into the current block.
+    """
+    def __init__(self, start_value, block_size=64):
+        self.block_start = np.asarray(start_value)
+        self.block_size = block_size
+        dtype = self.block_start.dtype
+        # Offsets of the samples within a block and the step between the blocks are the same
+        # for every block, so they are computed only once
+        self._offsets = np.arange(block_size).astype(dtype).reshape(
+            (-1,) + (1,) * self.block_start.ndim)
+        self._block_step = np.array(block_size).astype(dtype)
+        self.idx = 0
+        self._fill()
+
+    def _fill(self):
+        # A new buffer is allocated for every block, so the views returned earlier stay valid
+        self.buf = self.block_start[np.newaxis] + self._offsets
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        result = self.value
-        self.value = self.value + np.array(1, dtype=self.value.dtype)
+        if self.idx == self.block_size:
+            self.block_start = self.block_start + self._block_step
+            self.idx = 0
+            self._fill()
+        result = self.buf[self.idx, ...]
+        self.idx += 1
         return result
 
 @pipeline_def
-def one_input_pipeline(def_for_dataset, device, source, external_source_device):
+def one_input_pipeline(def_for_dataset, device, source, external_source_device, dtype=None,
+                       fixed_shape=False):
     """Pipeline accepting single input via external source
 
     Parameters
@@ -94,6 +149,10 @@ def one_input_pipeline(def_for_dataset, device, source, external_source_device):
         callback for the external source in baseline pipeline otherwise None
     external_source_device : str
         Device that we want the external source in TF dataset to be placed
+    dtype : numpy type, optional
+        type of the input samples
+    fixed_shape : bool, optional
+        True if all the input samples have the same shape, so they don't need padding
     """
     if def_for_dataset:
         # We use no copy when the input memory is matching the external source placement,
@@ -107,11 +166,20 @@ def one_input_pipeline(def_for_dataset, device, source, external_source_device):
                                    batch=False,
                                    device=external_source_device)
     input = input if device == 'cpu' else input.gpu()
-    processed = fn.cast(input + 10, dtype=dali.types.INT32)
+    if fixed_shape:
+        return input, _add_ten_as_int32(input, dtype)
+    processed = _add_ten_as_int32(input, dtype)
     input_padded, processed_padded = fn.pad([input, processed])
     return input_padded, processed_padded
 
 
+def _to_gpu(input_dataset):
+    input_dataset = input_dataset.apply(tf.data.experimental.copy_to_device('/gpu:0'))
+    # Prefetch on GPU, so the copies of the samples for the next batch overlap with DALI processing
+    with tf.device('/gpu:0'):
+        return input_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 # Test that uses Tensor and Repeat (infinite) datasets as inputs to DALI pipeline
 def external_source_converter_with_fixed_value(shape, dtype, tensor):
     def to_dataset(pipeline_desc, device_str):
@@ -119,7 +187,7 @@ def external_source_converter_with_fixed_value(shape, dtype, tensor):
             input_dataset = tf.data.Dataset.from_tensors(tensor).repeat()
             # If we place DALIDataset on GPU we need the remote call + manual data transfer
             if "gpu" in device_str:
-                input_dataset = input_dataset.apply(tf.data.experimental.copy_to_device('/gpu:0'))
+                input_dataset = _to_gpu(input_dataset)
 
 
         dataset_pipeline, shapes, dtypes = pipeline_desc
@@ -139,16 +207,17 @@ def external_source_converter_with_fixed_value(shape, dtype, tensor):
 
 # Test that uses Generator dataset as inputs to DALI pipeline
 def external_source_converter_with_callback(input_iterator, shape, dtype, *args):
+    _args = (shape, dtype(0)) + tuple(args)
+    out_shape = (None,) * len(shape)
+    tf_type = tf.dtypes.as_dtype(dtype)
+
     def to_dataset(pipeline_desc, device_str):
         with tf.device('/cpu:0'):
-            _args = (shape, dtype(0)) + tuple(args)
-            out_shape = tuple(None for _ in shape)
-            tf_type = tf.dtypes.as_dtype(dtype)
             input_dataset = tf.data.Dataset.from_generator(
                 input_iterator, output_types=tf_type, output_shapes=out_shape, args=_args)
             # If we place DALIDataset on GPU we need the remote call + manual data transfer
             if "gpu" in device_str:
-                input_dataset = input_dataset.apply(tf.data.experimental.copy_to_device('/gpu:0'))
+                input_dataset = _to_gpu(input_dataset)
 
         dataset_pipeline, shapes, dtypes = pipeline_desc
 
@@ -167,6 +236,9 @@ def external_source_converter_with_callback(input_iterator, shape, dtype, *args)
 
 @nottest
 def external_source_tester(shape, dtype, source=None, external_source_device="cpu"):
+    # Only the random samples differ in shape, the other iterators repeat or increment one value
+    fixed_shape = isinstance(source, (FixedSampleIterator, InfiniteSampleIterator))
+
     def get_external_source_pipeline_getter(batch_size, num_threads, device, device_id=0,
         shard_id=0, num_shards=1, def_for_dataset=False):
 
@@ -174,18 +246,21 @@ def external_source_tester(shape, dtype, source=None, external_source_device="cp
                                   device,
                                   source,
                                   external_source_device,
+                                  dtype,
+                                  fixed_shape=fixed_shape,
                                   batch_size=batch_size,
                                   num_threads=num_threads,
                                   device_id=device_id)
 
-        batch_shape = (batch_size,) + tuple(None for _ in shape)
+        batch_shape = (batch_size,) + (None,) * len(shape)
 
         return pipe, (batch_shape, batch_shape), (tf.dtypes.as_dtype(dtype), tf.int32)
     return get_external_source_pipeline_getter
 
 
 @pipeline_def
-def many_input_pipeline(def_for_dataset, device, sources, input_names):
+def many_input_pipeline(def_for_dataset, device, sources, input_names, dtypes=None,
+                        stacked_input=None, fixed_shape=False):
     """ Pipeline accepting multiple inputs via external source
 
     Parameters
@@ -198,11 +273,24 @@ def many_input_pipeline(def_for_dataset, device, sources, input_names):
         callbacks for the external sources in baseline pipeline otherwise None
     input_names : list of str
         Names of inputs placeholder for TF
+    dtypes : list of numpy types, optional
+        types of the samples of respective inputs
+    stacked_input : str, optional
+        Name of the input placeholder for TF, that provides all the inputs stacked in the outermost
+        dimension. If provided, the `input_names` are used only to get the number of inputs.
+    fixed_shape : bool, optional
+        True if all the samples of every input have the same shape, so they don't need padding
     """
     inputs = []
-    if def_for_dataset:
+    if def_for_dataset and stacked_input is not None:
+        stacked = fn.external_source(name=stacked_input, no_copy=True, device=device)
+        stacked = stacked if device == 'cpu' else stacked.gpu()
+        inputs = fn.element_extract(stacked, element_map=list(range(len(input_names))))
+    elif def_for_dataset:
+        # The input datasets are placed on the same device as the Dataset, so the external sources
+        # can use that placement as well and skip the copy of the data passed from TF
         for input_name in input_names:
-            input = fn.external_source(name=input_name)
+            input = fn.external_source(name=input_name, no_copy=True, device=device)
             input = input if device == 'cpu' else input.gpu()
             inputs.append(input)
     else:
@@ -211,25 +299,47 @@ def many_input_pipeline(def_for_dataset, device, sources, input_names):
             input = input if device == 'cpu' else input.gpu()
             inputs.append(input)
     processed = []
-    for input in inputs:
-        processed.append(fn.cast(input + 10, dtype=dali.types.INT32))
+    if dtypes is None:
+        dtypes = [None] * len(inputs)
+    for input, dtype in zip(inputs, dtypes):
+        processed.append(_add_ten_as_int32(input, dtype))
+    if fixed_shape:
+        return tuple(inputs + processed)
     results = fn.pad(inputs + processed)
     return tuple(results)
 
 
-# Test that uses multiple Generator dataset as inputs to DALI pipeline
+_STACKED_INPUT_NAME = "stacked_input"
+
+
+def _can_stack(start_values):
+    """Multiple non-scalar inputs of the same type and shape can be passed to DALI as one stacked
+    input (`fn.element_extract` needs at least 2D input to split it)"""
+    return len(start_values) > 1 and start_values[0].ndim > 0 and all(
+        value.dtype == start_values[0].dtype and value.shape == start_values[0].shape
+        for value in start_values)
+
+
+# Test that uses multiple Generator dataset as inputs to DALI pipeline.
+# When possible, the inputs are stacked into one Generator dataset, so there is only one
+# (bigger) copy to the GPU, and split back inside the DALI pipeline (one copy per input).
 def external_source_converter_multiple(start_values, input_names):
+    if _can_stack(start_values):
+        inputs = [(np.stack(start_values), _STACKED_INPUT_NAME)]
+    else:
+        inputs = list(zip(start_values, input_names))
+    dataset_input_names = tuple(name for _, name in inputs)
+    inputs = [(value, tf.dtypes.as_dtype(value.dtype), value.shape) for value, _ in inputs]
+
     def to_dataset(pipeline_desc, device_str):
         with tf.device('/cpu:0'):
             input_datasets = []
-            for value, name in zip(start_values, input_names):
-                tf_type = tf.dtypes.as_dtype(value.dtype)
-                shape = value.shape
+            for value, tf_type, shape in inputs:
                 input_dataset = tf.data.Dataset.from_generator(
                     InfiniteSampleIterator, output_types=tf_type, output_shapes=shape, args=(value,))
                 # If we place DALIDataset on GPU we need the remote call + manual data transfer
                 if "gpu" in device_str:
-                    input_dataset = input_dataset.apply(tf.data.experimental.copy_to_device('/gpu:0'))
+                    input_dataset = _to_gpu(input_dataset)
                 input_datasets.append(input_dataset)
 
         dataset_pipeline, shapes, dtypes = pipeline_desc
@@ -237,7 +347,7 @@ def external_source_converter_multiple(start_values, input_names):
         with tf.device(device_str):
             dali_dataset = dali_tf.experimental.DALIDatasetWithInputs(
                     input_datasets=tuple(input_datasets),
-                    input_names=tuple(input_names),
+                    input_names=dataset_input_names,
                     pipeline=dataset_pipeline,
                     batch_size=dataset_pipeline.batch_size,
                     output_shapes=shapes,
@@ -253,7 +363,7 @@ def external_source_tester_multiple(start_values, input_names):
         shard_id=0, num_shards=1, def_for_dataset=False):
 
         sources = [InfiniteSampleIterator(start_value) for start_value in start_values]
-        output_shapes = [((batch_size, ) + tuple(None for _ in start_value.shape))
+        output_shapes = [((batch_size, ) + (None,) * start_value.ndim)
                          for start_value in start_values]
         output_shapes = tuple(output_shapes + output_shapes)
         output_dtypes = tuple(
@@ -264,6 +374,9 @@ def external_source_tester_multiple(start_values, input_names):
                                    device,
                                    sources,
                                    input_names,
+                                   [start_value.dtype for start_value in start_values],
+                                   _STACKED_INPUT_NAME if _can_stack(start_values) else None,
+                                   fixed_shape=True,
                                    batch_size=batch_size,
                                    num_threads=num_threads,
                                    device_id=device_id)
@@ -266,12 +266,20 @@ class RandomlyShapedDataIterator(object):
         self.seed = seed
         self.np_rng = np.random.default_rng(seed=seed)
         self.rng = random.Random(seed)
+        self.initial_state = (seed, self.rng.getstate(), self.np_rng.bit_generator.state)
 
     def __iter__(self):
         self.i = 0
         self.n = self.batch_size
         return self
 
+    def reset(self):
+        """Restart the sequence of generated batches from the beginning"""
+        self.seed, rng_state, np_rng_state = self.initial_state
+        self.rng.setstate(rng_state)
+        self.np_rng.bit_generator.state = np_rng_state
+        return iter(self)
+
     def __next__(self):
         import_numpy()
         np.random.seed(self.seed)